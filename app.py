@@ -7,6 +7,10 @@ import uuid
 import os
 import io
 import zipfile
+import tempfile
+import xlsxwriter
+import threading
+from contextlib import contextmanager
 
 # =====================================================
 # CONFIG
@@ -29,60 +33,353 @@ RI = {
     6: 1.24, 7: 1.32, 8: 1.41, 9: 1.45, 10: 1.49
 }
 
+def _lambda_max(m, tol=1e-10, max_iter=20):
+    # Método de potencias por cuadrados sucesivos: las filas de m^(2^k)
+    # convergen al vector de Perron en pocas multiplicaciones
+    b = m / m.sum()
+    w = b.sum(axis=1)
+    for _ in range(max_iter):
+        b = b @ b
+        b /= b.sum()
+        w_prev, w = w, b.sum(axis=1)
+        if np.max(np.abs(w - w_prev)) < tol:
+            break
+    return float((m @ w).sum())
+
+def _lambda_max_3(m):
+    # Forma cerrada para 3x3 recíprocas: 1 + t + 1/t, t = (a12·a23/a13)^(1/3)
+    t = (m[0, 1] * m[1, 2] / m[0, 2]) ** (1.0 / 3.0)
+    return 1.0 + t + 1.0 / t
+
+LAMBDA_MAX_IMPL = {3: _lambda_max_3}
+
 def calculate_cr(matrix):
-    matrix = np.array(matrix)
-    n = matrix.shape[0]
-    eigvals, _ = np.linalg.eig(matrix)
-    lambda_max = max(eigvals.real)
+    m = np.asarray(matrix, dtype=np.float64)
+    n = m.shape[0]
+    # Toda matriz recíproca de orden <= 2 es consistente; sin RI para n > 10
+    if n < 3 or n not in RI:
+        return 0.0
+
+    # Matriz totalmente consistente: a_ij = a_i1 · a_1j
+    if np.allclose(m, m[:, :1] * m[:1, :], rtol=1e-9):
+        return 0.0
+
+    lambda_max = LAMBDA_MAX_IMPL.get(n, _lambda_max)(m)
     CI = (lambda_max - n) / (n - 1)
-    CR = CI / RI[n] if n in RI else 0
+    CR = CI / RI[n]
     return round(CR, 4)
 
 # =====================================================
 # DATABASE
 # =====================================================
+SCHEMA_VERSION = 3
+
+# Solo se guarda la mitad superior (i < j): la diagonal es 1 y la
+# mitad inferior es recíproca
+def matrix_to_blob(matrix):
+    m = np.asarray(matrix, dtype="<f8")
+    return m[np.triu_indices(m.shape[0], 1)].tobytes()
+
+def blob_to_matrix(data, n):
+    upper = np.frombuffer(data, dtype="<f8")
+    matrix = np.ones((n, n))
+    iu = np.triu_indices(n, 1)
+    matrix[iu] = upper
+    matrix.T[iu] = 1.0 / upper
+    return matrix
+
+@st.cache_resource
 def get_db():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Conexión de escritura compartida, solo a través de transaction().
+    # Autocommit: cada escritura abre su propia transacción
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-20000")
+    con.execute("PRAGMA mmap_size=268435456")
+    return con
+
+@st.cache_resource
+def _db_lock():
+    # La conexión es compartida entre sesiones (hilos)
+    return threading.Lock()
+
+@contextmanager
+def transaction():
+    con = get_db()
+    with _db_lock():
+        con.execute("BEGIN")
+        try:
+            yield con.cursor()
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+@contextmanager
+def read_cursor():
+    # Las lecturas usan su propia conexión: con WAL no ven la transacción
+    # que otra sesión tenga abierta en get_db(), ni la bloquean
+    con = sqlite3.connect(DB_PATH, isolation_level=None)
+    try:
+        con.execute("PRAGMA query_only=ON")
+        yield con.cursor()
+    finally:
+        con.close()
+
+def _migrate_matrices_v1(cur):
+    # v0 guardaba una fila por celda (response_id, i, j, value)
+    cur.execute("PRAGMA table_info(matrices)")
+    if "i" not in [c[1] for c in cur.fetchall()]:
+        return
+
+    cur.execute("ALTER TABLE matrices RENAME TO matrices_v0")
+    cur.execute("""
+    CREATE TABLE matrices (
+        response_id TEXT PRIMARY KEY,
+        n INTEGER,
+        data BLOB
+    )
+    """)
+
+    cur.execute("SELECT response_id, i, j, value FROM matrices_v0")
+    cells = {}
+    for rid, i, j, v in cur.fetchall():
+        cells.setdefault(rid, []).append((i, j, v))
+
+    for rid, data in cells.items():
+        ii, jj, vv = (np.array(c) for c in zip(*data))
+        size = int(max(ii.max(), jj.max())) + 1
+        # Basta la mitad superior; cubre también respuestas sin la inferior
+        up = ii < jj
+        matrix = np.ones((size, size))
+        matrix[ii[up], jj[up]] = vv[up]
+        matrix[jj[up], ii[up]] = 1.0 / vv[up]
+        cur.execute("INSERT INTO matrices VALUES (?,?,?)",
+                    (rid, size, matrix_to_blob(matrix)))
+
+    cur.execute("DROP TABLE matrices_v0")
+
+def _create_tables(cur):
+    # id INTEGER para uniones e índices; public_id (uuid) solo en enlaces
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS projects (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        public_id TEXT UNIQUE,
+        name TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS criteria (
+        project_id INTEGER,
+        name TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS responses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        public_id TEXT UNIQUE,
+        project_id INTEGER,
+        user_name TEXT,
+        cr REAL
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS matrices (
+        response_id INTEGER PRIMARY KEY,
+        n INTEGER,
+        data BLOB
+    )
+    """)
+
+def _migrate_integer_ids_v2(cur):
+    # v1 usaba el uuid TEXT como clave en todas las tablas
+    cur.execute("PRAGMA table_info(projects)")
+    cols = [c[1] for c in cur.fetchall()]
+    if not cols or "public_id" in cols:
+        return
+
+    for table in ("projects", "criteria", "responses", "matrices"):
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+
+    _create_tables(cur)
+
+    cur.execute("""
+        INSERT INTO projects (public_id, name)
+        SELECT id, name FROM projects_v1 ORDER BY rowid
+    """)
+    cur.execute("""
+        INSERT INTO criteria (project_id, name)
+        SELECT p.id, c.name
+        FROM criteria_v1 c
+        JOIN projects p ON p.public_id = c.project_id
+        ORDER BY c.rowid
+    """)
+    cur.execute("""
+        INSERT INTO responses (public_id, project_id, user_name, cr)
+        SELECT r.id, p.id, r.user_name, r.cr
+        FROM responses_v1 r
+        LEFT JOIN projects p ON p.public_id = r.project_id
+        ORDER BY r.rowid
+    """)
+    cur.execute("""
+        INSERT INTO matrices (response_id, n, data)
+        SELECT r.id, m.n, m.data
+        FROM matrices_v1 m
+        JOIN responses r ON r.public_id = m.response_id
+    """)
+
+    for table in ("projects", "criteria", "responses", "matrices"):
+        cur.execute(f"DROP TABLE {table}_v1")
+
+def _migrate_upper_triangle_v3(cur):
+    # v2 guardaba la matriz n x n completa en el BLOB
+    cur.execute("SELECT response_id, n, data FROM matrices")
+    for rid, size, data in cur.fetchall():
+        if len(data) != size * size * 8:
+            continue
+        full = np.frombuffer(data, dtype="<f8").reshape(size, size)
+        cur.execute("UPDATE matrices SET data=? WHERE response_id=?",
+                    (matrix_to_blob(full), rid))
 
 def init_db():
-    with get_db() as con:
-        cur = con.cursor()
+    # Esquema al día: no hace falta transacción ni DDL
+    with read_cursor() as cur:
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] == SCHEMA_VERSION:
+            return
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS projects (
-            id TEXT PRIMARY KEY,
-            name TEXT
-        )
-        """)
+    with transaction() as cur:
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS criteria (
-            project_id TEXT,
-            name TEXT
-        )
-        """)
+        if version < 1:
+            _migrate_matrices_v1(cur)
+        if version < 2:
+            _migrate_integer_ids_v2(cur)
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS responses (
-            id TEXT PRIMARY KEY,
-            project_id TEXT,
-            user_name TEXT,
-            cr REAL
-        )
-        """)
+        _create_tables(cur)
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS matrices (
-            response_id TEXT,
-            i INTEGER,
-            j INTEGER,
-            value REAL
-        )
-        """)
+        if version < 3:
+            _migrate_upper_triangle_v3(cur)
+
+        # matrices.response_id ya está indexado por ser PRIMARY KEY
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_crit_pid ON criteria(project_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_resp_pid ON responses(project_id)")
+
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+@st.cache_resource
+def _init_once():
+    init_db()
+
+_init_once()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_projects():
+    with read_cursor() as cur:
+        cur.execute("SELECT id, name FROM projects")
+        return cur.fetchall()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_project(public_id):
+    with read_cursor() as cur:
+        cur.execute("SELECT id FROM projects WHERE public_id=?", (public_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_criteria(pid):
+    with read_cursor() as cur:
+        cur.execute("SELECT name FROM criteria WHERE project_id=?", (pid,))
+        return [c[0] for c in cur.fetchall()]
+
+@st.cache_data(show_spinner=False)
+def pair_indices(n):
+    pairs = list(itertools.combinations(range(n), 2))
+    return np.array(pairs, dtype=np.intp).reshape(-1, 2)
+
+@st.cache_data(show_spinner=False)
+def survey_pairs(criteria):
+    pairs = pair_indices(len(criteria))
+    names = np.array(criteria, dtype=object)
+    table = pd.DataFrame({
+        "Criterio A": names[pairs[:, 0]],
+        "Criterio B": names[pairs[:, 1]],
+        "Más importante": "",
+        "Intensidad": np.nan,
+    })
+    return pairs, table
 
-        con.commit()
+# =====================================================
+# EXCEL
+# =====================================================
+def fast_write_matrix_xlsx(buf, matrix, criteria, cr):
+    # xlsxwriter escribe filas completas sin modelo de celdas ni estilos
+    wb = xlsxwriter.Workbook(buf, {"in_memory": True})
+
+    ws = wb.add_worksheet("Matriz_AHP")
+    ws.write_row(0, 1, criteria)
+    for r, (name, row) in enumerate(zip(criteria, matrix.tolist()), 1):
+        ws.write(r, 0, name)
+        ws.write_row(r, 1, row)
+
+    ws = wb.add_worksheet("Consistencia")
+    ws.write_row(0, 0, ("Métrica", "Valor"))
+    ws.write_row(1, 0, ("CR", cr))
+
+    wb.close()
+
+@st.cache_data(max_entries=300, ttl=3600, show_spinner=False)
+def response_xlsx(response_id, _criteria, _size, _data, _cr):
+    # Una respuesta no cambia una vez enviada: basta su id como clave
+    buf = io.BytesIO()
+    fast_write_matrix_xlsx(buf, blob_to_matrix(_data, _size), _criteria, _cr)
+    return buf.getvalue()
+
+def responses_zip(criteria, responses):
+    # TemporaryFile se borra al cerrarse, también si algo falla
+    with tempfile.TemporaryFile() as tmp:
+        # Los .xlsx ya van comprimidos: ZIP_STORED evita recomprimirlos
+        with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as zipf:
+            for rid, user, cr, size, data in responses:
+                zipf.writestr(
+                    f"{user}.xlsx",
+                    response_xlsx(rid, criteria, size, data, cr)
+                )
+        tmp.seek(0)
+        return tmp.read()
 
-init_db()
+# =====================================================
+# CSV
+# =====================================================
+def responses_csv(project, criteria, responses):
+    # Formato largo: una fila por celda de cada matriz
+    n = len(criteria)
+    k = len(responses)
+    ii, jj = np.divmod(np.arange(n * n), n)
+    names = np.array(criteria, dtype=object)
+
+    df = pd.DataFrame({
+        "project": project,
+        "response_id": np.repeat([r[0] for r in responses], n * n),
+        "user": np.repeat([r[1] for r in responses], n * n),
+        "i": np.tile(ii, k),
+        "j": np.tile(jj, k),
+        "criterion_i": np.tile(names[ii], k),
+        "criterion_j": np.tile(names[jj], k),
+        "value": np.concatenate([
+            blob_to_matrix(data, size).ravel()
+            for _, _, _, size, data in responses
+        ]),
+        "cr": np.repeat([r[2] for r in responses], n * n),
+    })
+    # BOM para que Excel reconozca las tildes
+    return df.to_csv(index=False).encode("utf-8-sig")
 
 # =====================================================
 # ROUTING
@@ -114,12 +411,15 @@ if project_id is None:
 
         pid = str(uuid.uuid4())
 
-        with get_db() as con:
-            cur = con.cursor()
-            cur.execute("INSERT INTO projects VALUES (?,?)", (pid, project_name))
+        with transaction() as cur:
+            cur.execute("""
+                INSERT INTO projects (public_id, name) VALUES (?,?)
+            """, (pid, project_name))
+            project_key = cur.lastrowid
             for c in criteria:
-                cur.execute("INSERT INTO criteria VALUES (?,?)", (pid, c))
-            con.commit()
+                cur.execute("INSERT INTO criteria VALUES (?,?)", (project_key, c))
+
+        load_projects.clear()
 
         APP_URL = "https://app-encuesta-ahp.streamlit.app"
         st.success("Proyecto creado correctamente")
@@ -131,10 +431,7 @@ if project_id is None:
     # -------- DESCARGAR RESULTADOS --------
     st.subheader("📥 DESCARGAR RESULTADOS")
 
-    with get_db() as con:
-        cur = con.cursor()
-        cur.execute("SELECT id, name FROM projects")
-        projects = cur.fetchall()
+    projects = load_projects()
 
     if not projects:
         st.info("No hay proyectos creados aún")
@@ -144,55 +441,42 @@ if project_id is None:
     selected_project = st.selectbox("Proyecto", list(project_map.keys()))
     selected_pid = project_map[selected_project]
 
-    with get_db() as con:
-        cur = con.cursor()
+    # Respuestas y matrices del proyecto en una sola consulta
+    with read_cursor() as cur:
         cur.execute("""
-            SELECT id, user_name, cr
-            FROM responses
-            WHERE project_id=?
+            SELECT r.public_id, r.user_name, r.cr, m.n, m.data
+            FROM responses r
+            JOIN matrices m ON m.response_id = r.id
+            WHERE r.project_id=?
         """, (selected_pid,))
         responses = cur.fetchall()
 
-        cur.execute("SELECT name FROM criteria WHERE project_id=?", (selected_pid,))
-        criteria = [c[0] for c in cur.fetchall()]
+    criteria = load_criteria(selected_pid)
 
     if not responses:
         st.warning("Este proyecto no tiene respuestas")
         st.stop()
 
-    # -------- ZIP CON TODAS --------
-    zip_buffer = io.BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, "w") as zipf:
-        for rid, user, cr in responses:
-            with get_db() as con:
-                cur = con.cursor()
-                cur.execute("""
-                    SELECT i, j, value
-                    FROM matrices
-                    WHERE response_id=?
-                """, (rid,))
-                data = cur.fetchall()
-
-            size = len(criteria)
-            matrix = np.ones((size, size))
-            for i, j, v in data:
-                matrix[i][j] = v
-
-            df_m = pd.DataFrame(matrix, index=criteria, columns=criteria)
-            df_c = pd.DataFrame({"CR": [cr]})
-
-            buf = io.BytesIO()
-            with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-                df_m.to_excel(writer, sheet_name="Matriz_AHP")
-                df_c.to_excel(writer, sheet_name="Consistencia", index=False)
-
-            zipf.writestr(f"{user}.xlsx", buf.getvalue())
+    # data como función: cada archivo solo se arma al pulsar su botón, y
+    # on_click="ignore" evita reejecutar la página al descargar
 
+    # -------- CSV CON TODAS --------
     st.download_button(
-        "⬇️ Descargar TODAS las matrices (ZIP)",
-        data=zip_buffer.getvalue(),
-        file_name=f"Resultados_{selected_project}.zip"
+        "⬇️ Descargar TODAS las respuestas (CSV)",
+        data=lambda: responses_csv(selected_project, criteria, responses),
+        file_name=f"Resultados_{selected_project}.csv",
+        mime="text/csv",
+        type="primary",
+        on_click="ignore"
+    )
+
+    # -------- ZIP CON TODAS --------
+    st.download_button(
+        "⬇️ Descargar TODAS las matrices en Excel (ZIP)",
+        data=lambda: responses_zip(criteria, responses),
+        file_name=f"Resultados_{selected_project}.zip",
+        mime="application/zip",
+        on_click="ignore"
     )
 
 # =====================================================
@@ -204,10 +488,12 @@ else:
     Identificación de zonas óptimas para el cultivo de café arábigo en la cuenca hidrográfica del río La Paila, 
     mediante la integración de análisis geoespacial y evaluación multicriterio""")
 
-    with get_db() as con:
-        cur = con.cursor()
-        cur.execute("SELECT name FROM criteria WHERE project_id=?", (project_id,))
-        criteria = [c[0] for c in cur.fetchall()]
+    project_key = load_project(project_id)
+    if project_key is None:
+        st.error("El enlace de la encuesta no es válido")
+        st.stop()
+
+    criteria = load_criteria(project_key)
 
     st.markdown("""
     El **Proceso Analítico Jerárquico (AHP)** es un método multicriterio ampliamente utilizado para la toma de decisiones complejas, 
@@ -246,70 +532,82 @@ else:
     **Tenga en cuenta que un CR menor a 0.10 indica consistencia aceptable**
     """)
 
-    user_name = st.text_input("INGRESE SU NOMBRE")
-
-    pairs = list(itertools.combinations(range(len(criteria)), 2))
+    pairs, table = survey_pairs(tuple(criteria))
     matrix = np.ones((len(criteria), len(criteria)))
 
-    st.subheader("COMPARACIONES POR PARES")
+    # El formulario evita una ejecución completa del script por cada celda
+    with st.form("ahp", clear_on_submit=False):
+        user_name = st.text_input("INGRESE SU NOMBRE")
+
+        st.subheader("COMPARACIONES POR PARES")
+
+        edited = st.data_editor(
+            table,
+            column_config={
+                "Más importante": st.column_config.SelectboxColumn(
+                    options=["", *criteria]
+                ),
+                "Intensidad": st.column_config.NumberColumn(
+                    min_value=1, max_value=9, step=1, format="%d"
+                ),
+            },
+            disabled=["Criterio A", "Criterio B"],
+            hide_index=True,
+            width="stretch",
+            key="ahp_pairs"
+        )
 
-    for i, j in pairs:
-        c1, c2, c3 = st.columns([4, 4, 3])
+        submitted = st.form_submit_button("ENVIAR ENCUESTA")
 
-        with c1:
-            choice = st.selectbox(
-                f"{criteria[i]} vs {criteria[j]}",
-                ["", criteria[i], criteria[j]],
-                key=f"c_{i}_{j}"
-            )
+    choice = edited["Más importante"].fillna("").to_numpy()
+    value = edited["Intensidad"].to_numpy(dtype=np.float64)
+    first = choice == edited["Criterio A"].to_numpy()
+    second = choice == edited["Criterio B"].to_numpy()
 
-        with c2:
-            value = st.selectbox(
-                "Intensidad",
-                ["", 1, 2, 3, 4, 5, 6, 7, 8, 9],
-                key=f"v_{i}_{j}"
-            )
+    answered = (choice != "") & ~np.isnan(value)
+    invalid = answered & ~(first | second)
 
-        if choice and value:
-            if choice == criteria[i]:
-                matrix[i][j] = value
-                matrix[j][i] = 1 / value
-            else:
-                matrix[j][i] = value
-                matrix[i][j] = 1 / value
+    # Una sola escritura vectorizada: matrix[a, b] = v, matrix[b, a] = 1/v
+    ok = answered & ~invalid
+    if ok.any():
+        idx = pairs[ok]
+        ia = np.where(first[ok], idx[:, 0], idx[:, 1])
+        ja = np.where(first[ok], idx[:, 1], idx[:, 0])
+        vv = value[ok]
+        matrix[ia, ja] = vv
+        matrix[ja, ia] = 1.0 / vv
 
-    if st.button("ENVIAR ENCUESTA"):
+    if submitted:
         if not user_name:
             st.error("INGRESE SU NOMBRE")
             st.stop()
 
+        if invalid.any():
+            rows = ", ".join(str(k + 1) for k in np.flatnonzero(invalid))
+            st.error(
+                f"Filas {rows}: el criterio más importante debe ser "
+                "uno de los dos criterios comparados"
+            )
+            st.stop()
+
         cr = calculate_cr(matrix)
         response_id = str(uuid.uuid4())
 
-        with get_db() as con:
-            cur = con.cursor()
+        with transaction() as cur:
             cur.execute("""
-                INSERT INTO responses VALUES (?,?,?,?)
-            """, (response_id, project_id, user_name, cr))
-
-            for i in range(len(criteria)):
-                for j in range(len(criteria)):
-                    cur.execute("""
-                        INSERT INTO matrices VALUES (?,?,?,?)
-                    """, (response_id, i, j, float(matrix[i][j])))
+                INSERT INTO responses (public_id, project_id, user_name, cr)
+                VALUES (?,?,?,?)
+            """, (response_id, project_key, user_name, cr))
 
-            con.commit()
+            cur.execute("""
+                INSERT INTO matrices VALUES (?,?,?)
+            """, (cur.lastrowid, len(criteria), matrix_to_blob(matrix)))
 
         st.success("Encuesta enviada correctamente, gracias por su contribución")
         st.metric("Consistency Ratio (CR)", cr)
 
-        df_m = pd.DataFrame(matrix, index=criteria, columns=criteria)
-        df_c = pd.DataFrame({"CR": [cr]})
-
         buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            df_m.to_excel(writer, sheet_name="Matriz_AHP")
-            df_c.to_excel(writer, sheet_name="Consistencia", index=False)
+        fast_write_matrix_xlsx(buffer, matrix, criteria, cr)
 
         st.download_button(
             "Descargar su matriz AHP",